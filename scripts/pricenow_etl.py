@@ -1,11 +1,23 @@
 import time
 import math
+import random
+import functools
+import contextlib
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 from supabase import create_client
+import psycopg
+from psycopg import sql
 import os
 from dotenv import load_dotenv
 
@@ -45,7 +57,7 @@ def _fetch_token():
         "content-type": "application/json",
         "pratiq-api-version": AUTH_VERSION_HEADER,
     }
-    resp = requests.post(AUTH_URL, json=body, headers=headers, timeout=30)
+    resp = _session.post(AUTH_URL, json=body, headers=headers, timeout=30)
     if resp.status_code != 200:
         raise RuntimeError(f"Token request failed: {resp.status_code} {resp.text}")
     data = resp.json()
@@ -56,94 +68,271 @@ def _fetch_token():
 
 def _get_token():
     global _token, _token_expires_at
-    if _token_is_valid():
+    # price pages are fetched from several threads; only one of them may refresh the token
+    with _token_lock:
+        if _token_is_valid():
+            return _token
+        # try disk cache
+        cached_token, cached_expires_at = _load_cached_token_file()
+        if cached_token and time.time() < cached_expires_at - 60:
+            _token, _token_expires_at = cached_token, cached_expires_at
+            return _token
+        # fetch fresh
+        _fetch_token()
         return _token
-    # try disk cache
-    cached_token, cached_expires_at = _load_cached_token_file()
-    if cached_token and time.time() < cached_expires_at - 60:
-        _token, _token_expires_at = cached_token, cached_expires_at
+
+# called after a 401 with the token that was rejected; if another thread already replaced it, reuse the new one
+def _refresh_token(stale_token):
+    with _token_lock:
+        if _token == stale_token:
+            _fetch_token()
         return _token
-    # fetch fresh
-    _fetch_token()
-    return _token
 
-# request wrapper (401 refresh)
-def _authed_get(path, params=None):
-    token = _get_token()
+# ------------- rate limiting -----------------
+# One limiter shared by all threads calling the Pricenow API. Requests go out in bursts (up to the number of fetch
+# threads) while the API reports plenty of quota. Only when X-RateLimit-Remaining drops below RATE_LIMIT_LOW_REMAINING
+# are the last requests spread over the time until X-RateLimit-Reset. A pause pushed by one thread (exhausted quota,
+# 429) delays every thread's next request.
+def _rate_limit_wait():
+    global _next_request_at
+    with _rate_limit_lock:
+        now = time.monotonic()
+        start = max(now, _next_request_at)
+        _next_request_at = start + _request_interval
+    if start > now:
+        time.sleep(start - now)
+
+def _rate_limit_pause(delay):
+    global _next_request_at
+    with _rate_limit_lock:
+        _next_request_at = max(_next_request_at, time.monotonic() + delay)
+
+# X-RateLimit-Reset is either seconds until reset or an epoch timestamp; None if missing or unparseable
+def _rate_limit_reset_delay(value):
+    try:
+        reset = float(value)
+    except (TypeError, ValueError):
+        return None
+    if reset > 1e9:
+        reset -= time.time()
+    return min(max(reset, 0.0), RATE_LIMIT_MAX_DELAY)
+
+# adjust the request spacing from the quota headers; pause if the quota is used up,
+# or (on 429) for Retry-After / exponential backoff with jitter
+def _rate_limit_update(resp, attempt):
+    global _request_interval
+    if resp.status_code == 429:
+        retry_after = resp.headers.get("Retry-After", "")
+        delay = float(retry_after) if retry_after.isdigit() else min(30, 2 ** attempt) + random.uniform(0, 1)
+        _rate_limit_pause(min(delay, RATE_LIMIT_MAX_DELAY))
+        return
+
+    remaining = resp.headers.get("X-RateLimit-Remaining", "")
+    if not remaining.isdigit():
+        return
+    remaining = int(remaining)
+    # without a reset time there is no window to wait for; a following 429 backs off instead
+    reset_delay = _rate_limit_reset_delay(resp.headers.get("X-RateLimit-Reset"))
+    with _rate_limit_lock:
+        if remaining >= RATE_LIMIT_LOW_REMAINING or reset_delay is None:
+            _request_interval = 0.0
+        elif remaining > 0:
+            _request_interval = reset_delay / remaining
+    if remaining == 0 and reset_delay is not None:
+        _rate_limit_pause(reset_delay)
+
+# GET through the shared limiter; 429 responses are retried up to RATE_LIMIT_MAX_RETRIES times
+def _limited_get(url, headers, params):
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        _rate_limit_wait()
+        resp = _session.get(url, headers=headers, params=params, timeout=30)
+        _rate_limit_update(resp, attempt)
+        if resp.status_code != 429:
+            break
+    return resp
+
+# request wrapper (401 refresh); headers_tpl is one of the prebuilt header dicts (_HEADERS_MAIN / _HEADERS_PRICING)
+def _authed_get(path, params, headers_tpl):
     url = f"{API_BASE}{path}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json",
-        "pratiq-api-version": MAIN_API_VERSION,
-    }
-    resp = requests.get(url, headers=headers, params=params, timeout=30)
+    token = _get_token()
+    headers = {**headers_tpl, "Authorization": f"Bearer {token}"}
+    resp = _limited_get(url, headers, params)
     if resp.status_code == 401:
         # refresh once and retry
-        _fetch_token()
-        headers["Authorization"] = f"Bearer {_get_token()}"
-        resp = requests.get(url, headers=headers, params=params, timeout=30)
+        headers["Authorization"] = f"Bearer {_refresh_token(token)}"
+        resp = _limited_get(url, headers, params)
     return resp
 
 # ------------- database upsert helpers -----------------
+# Supabase client: created on first use, then reused (avoids rebuilding the HTTP client on repeated runs in one process)
+@functools.lru_cache(maxsize=1)
+def get_supabase():
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
 # Convert DF to list of dicts, replacing NaN with None.
+# Goes through Arrow: one columnar pass, nulls come out as None and numpy scalars as plain Python values.
 def _df_to_records(df: pd.DataFrame) -> list[dict]:
     if df.empty:
         return []
-    return (
-        df.where(pd.notnull(df), None)  # NaN -> None
-          .to_dict(orient="records")
-    )
-
-# Upsert a DataFrame into Supabase in chunks. on_conflict: column name or comma-separated string or list of column names.
-def upsert_df(supabase_client, table: str, df: pd.DataFrame, on_conflict: str | list[str], chunk_size: int = 1000):
-    records = _df_to_records(df)
+    return pa.Table.from_pandas(df, preserve_index=False).to_pylist()
+
+# Connect to SUPABASE_DB_URL; returns None (callers fall back to PostgREST) if the database can't be reached,
+# e.g. the IPv6-only direct db.<ref>.supabase.co host from a runner without IPv6. After one failure the rest
+# of the run skips further attempts.
+def _db_connect():
+    global _db_unreachable
+    if _db_unreachable:
+        return None
+    try:
+        return psycopg.connect(SUPABASE_DB_URL, connect_timeout=10)
+    except psycopg.OperationalError as e:
+        _db_unreachable = True
+        print(f"Warning: could not connect to SUPABASE_DB_URL, falling back to PostgREST: {e}")
+        return None
+
+# Direct Postgres connection with one open transaction for all upserts inside the block (single commit,
+# readers never see one table updated without the other). Yields None if SUPABASE_DB_URL is not set or unreachable.
+@contextlib.contextmanager
+def db_transaction():
+    conn = _db_connect() if SUPABASE_DB_URL else None
+    if conn is None:
+        yield None
+        return
+    with conn, conn.transaction():
+        yield conn
+
+# Upsert records straight into Postgres: COPY them into a TEMP staging table, then merge with INSERT ... ON CONFLICT.
+# Runs in a single transaction (a savepoint if conn is already inside one); the staging table is dropped on commit.
+def copy_upsert_records(conn, table: str, records: list[dict], conflict_cols: list[str]):
+    columns = list(records[0].keys())
+    staging = f"_staging_{table}"
+    cols_sql = sql.SQL(", ").join(map(sql.Identifier, columns))
+    update_cols = [c for c in columns if c not in conflict_cols]
+    if update_cols:
+        on_conflict_sql = sql.SQL("DO UPDATE SET {}").format(sql.SQL(", ").join(
+            sql.SQL("{c} = EXCLUDED.{c}").format(c=sql.Identifier(c)) for c in update_cols
+        ))
+    else:
+        on_conflict_sql = sql.SQL("DO NOTHING")
+
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute(sql.SQL("CREATE TEMP TABLE {s} (LIKE {t} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+            s=sql.Identifier(staging), t=sql.Identifier(table),
+        ))
+        with cur.copy(sql.SQL("COPY {s} ({cols}) FROM STDIN").format(s=sql.Identifier(staging), cols=cols_sql)) as cp:
+            for r in records:
+                cp.write_row([r[c] for c in columns])
+        cur.execute(sql.SQL("INSERT INTO {t} ({cols}) SELECT {cols} FROM {s} ON CONFLICT ({keys}) {action}").format(
+            t=sql.Identifier(table),
+            s=sql.Identifier(staging),
+            cols=cols_sql,
+            keys=sql.SQL(", ").join(map(sql.Identifier, conflict_cols)),
+            action=on_conflict_sql,
+        ))
+
+# Split a chunk in halves until each part's JSON body stays below REST_MAX_PAYLOAD_BYTES (PostgREST request size limit)
+def _split_by_payload_size(chunk: list[dict]) -> list[list[dict]]:
+    if len(chunk) <= 1 or len(json.dumps(chunk)) <= REST_MAX_PAYLOAD_BYTES:
+        return [chunk]
+    mid = len(chunk) // 2
+    return _split_by_payload_size(chunk[:mid]) + _split_by_payload_size(chunk[mid:])
+
+# Upsert records (list of dicts) into Supabase in chunks. on_conflict: column name or comma-separated string or list of column names.
+# With an open connection (see db_transaction) the records are COPYed through it. Without one, large payloads go through
+# a direct Postgres COPY if SUPABASE_DB_URL is set; otherwise (and for small payloads) via PostgREST.
+def upsert_records(supabase_client, table: str, records: list[dict], on_conflict: str | list[str], chunk_size: int = 10_000, max_workers: int = 8, conn=None):
     if not records:
         return
 
-    if isinstance(on_conflict, list):
-        on_conflict = ",".join(on_conflict)
+    if isinstance(on_conflict, str):
+        on_conflict = [c.strip() for c in on_conflict.split(",")]
 
-    # chunked upserts
-    for i in range(0, len(records), chunk_size):
-        chunk = records[i:i+chunk_size]
+    if conn is not None:
+        copy_upsert_records(conn, table, records, on_conflict)
+        return
+
+    if SUPABASE_DB_URL and len(records) >= COPY_MIN_ROWS:
+        conn = _db_connect()
+        if conn is not None:
+            with conn:
+                copy_upsert_records(conn, table, records, on_conflict)
+            return
+
+    on_conflict = ",".join(on_conflict)
+
+    def upsert_chunk(chunk):
         supabase_client.table(table).upsert(
             chunk,
             on_conflict=on_conflict
         ).execute()
 
+    # chunked upserts; records are unique on the conflict columns, so chunks never touch the same rows
+    # and can be sent concurrently. list() re-raises the first failed chunk.
+    chunks = [
+        part
+        for i in range(0, len(records), chunk_size)
+        for part in _split_by_payload_size(records[i:i+chunk_size])
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(upsert_chunk, chunks))
+
+# Upsert a DataFrame into Supabase; see upsert_records
+def upsert_df(supabase_client, table: str, df: pd.DataFrame, on_conflict: str | list[str], chunk_size: int = 10_000, max_workers: int = 8, conn=None):
+    upsert_records(supabase_client, table, _df_to_records(df), on_conflict, chunk_size=chunk_size, max_workers=max_workers, conn=conn)
+
 # --------- product API methods ---------
+# returns the cached products payload entry {"params", "payload", "etag", "expires_at"} for these params, or None
+def _load_cached_products_file(params):
+    if PRODUCTS_CACHE_FILE.exists():
+        try:
+            data = json.loads(PRODUCTS_CACHE_FILE.read_text())
+            if data.get("params") == params:
+                return data
+        except Exception:
+            pass
+    return None
+
+def _save_cached_products_file(params, payload, etag):
+    PRODUCTS_CACHE_FILE.write_text(json.dumps({
+        "params": params,
+        "payload": payload,
+        "etag": etag,
+        "expires_at": time.time() + PRODUCTS_CACHE_TTL,
+    }))
+
 # Returns parsed JSON (dict/list of products)
+# The catalog rarely changes: a cached payload younger than PRODUCTS_CACHE_TTL is returned without an API call;
+# after that it is revalidated with If-None-Match (if the API sent an ETag) and reused on 304.
+# Cache hits are not flagged to the caller: the products rows still get the current run's updated_at.
 def get_products(page=0, order_by="name", order_dir="asc") -> dict:
     params = {
         "page": page,
         "orderBy": order_by,
         "orderDirection": order_dir,
     }
-    resp = _authed_get("/api/products/admin/", params=params)
-    resp.raise_for_status()
-    return resp.json()  # dict or list
+    cached = _load_cached_products_file(params)
+    if cached and time.time() < cached.get("expires_at", 0):
+        return cached["payload"]
 
-# ------ pricing API methods -----------
-def _authed_get_pricing(path, params=None):
-    token = _get_token()
-    url = f"{API_BASE}{path}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json",
-        "pratiq-api-version": PRICING_API_VERSION,
-    }
-    resp = requests.get(url, headers=headers, params=params, timeout=30)
-    if resp.status_code == 401:
-        _fetch_token()
-        headers["Authorization"] = f"Bearer {_get_token()}"
-        resp = requests.get(url, headers=headers, params=params, timeout=30)
+    headers_tpl = _HEADERS_MAIN
+    if cached and cached.get("etag"):
+        headers_tpl = {**_HEADERS_MAIN, "If-None-Match": cached["etag"]}
 
-    return resp
+    resp = _authed_get("/api/products/admin/", params, headers_tpl)
+    if resp.status_code == 304 and cached:
+        _save_cached_products_file(params, cached["payload"], cached["etag"])
+        return cached["payload"]
 
-def get_prices(product_definition_ids, date_from, date_to):
-    pid_csv = ",".join(str(x) for x in product_definition_ids) if isinstance(product_definition_ids, (list, tuple, set)) else str(product_definition_ids)
+    resp.raise_for_status()
+    payload = resp.json()  # dict or list
+    _save_cached_products_file(params, payload, resp.headers.get("ETag"))
+    return payload
+
+# ------ pricing API methods -----------
+# pid_csv: comma-separated productDefinitionIds, joined once by the caller
+def get_prices(pid_csv, date_from, date_to):
     params = {"productDefinitionIds": pid_csv, "from": date_from, "to": date_to}
-    resp = _authed_get_pricing("/api/pricing/admin/prices", params)
+    resp = _authed_get("/api/pricing/admin/prices", params, _HEADERS_PRICING)
     if not resp.ok:
         raise RuntimeError(f"Pricing request failed {resp.status_code}: {resp.text}")
 
@@ -160,8 +349,7 @@ def _extract_rows(payload):
                 return v
     return []  # nothing usable
 
-def get_prices_page(product_definition_ids, date_from, date_to, page=0, page_size=1000):
-    pid_csv = ",".join(str(x) for x in product_definition_ids) if isinstance(product_definition_ids, (list, tuple, set)) else str(product_definition_ids)
+def get_prices_page(pid_csv, date_from, date_to, page=0, page_size=1000):
     params = {
         "productDefinitionIds": pid_csv,
         "from": date_from,   # 'YYYY-MM-DD'
@@ -170,24 +358,48 @@ def get_prices_page(product_definition_ids, date_from, date_to, page=0, page_siz
         "pageSize": page_size,
     }
     # IMPORTANT: no trailing slash in the path
-    resp = _authed_get_pricing("/api/pricing/admin/prices", params)
+    resp = _authed_get("/api/pricing/admin/prices", params, _HEADERS_PRICING)
     if not resp.ok:
         raise RuntimeError(f"Pricing request failed {resp.status_code}: {resp.text}")
     return _extract_rows(resp.json())
 
-# fetch all pages. Returns a flat list of change rows: [{ 'validAt': 'YYYY-MM-DD', 'price': int, 'productDefinitionId': int }, ...]
-def get_prices_all(product_definition_ids, date_from, date_to, page_size=1000, max_pages=1000):
-    all_rows = []
-    page = 0
-    while page < max_pages:
-        rows = get_prices_page(product_definition_ids, date_from, date_to, page=page, page_size=page_size)
-        if not rows:
-            break
-        all_rows.extend(rows)
-        if len(rows) < page_size:
-            break
-        page += 1
-    return all_rows
+# Convert one page of change rows to an Arrow table with CHANGE_ROWS_SCHEMA. Columns are built per key with r.get(),
+# so a row missing a key only gets a null in that field (forward_fill_daily_grid drops such incomplete rows).
+# Types are inferred first and then cast safely, so e.g. a fractional price raises instead of being truncated.
+def _change_rows_table(rows) -> pa.Table:
+    tbl = pa.table({name: [r.get(name) for r in rows] for name in CHANGE_ROWS_SCHEMA.names})
+    tbl = tbl.cast(CHANGE_ROWS_SCHEMA)
+    # validAt may come with a time part ('2025-12-20T00:00:00Z'); keep 'YYYY-MM-DD'
+    return tbl.set_column(
+        CHANGE_ROWS_SCHEMA.get_field_index("validAt"),
+        "validAt",
+        pc.utf8_slice_codeunits(tbl["validAt"], 0, 10),
+    )
+
+# fetch all pages. Returns one Arrow table of change rows with the columns of CHANGE_ROWS_SCHEMA
+# ('productDefinitionId', 'validAt' as 'YYYY-MM-DD', 'price'); each page is converted to a columnar table as it arrives.
+# page 0 is fetched alone (usually the only page); if it is full, the following pages are fetched
+# concurrently in waves of max_workers until the first short/empty page.
+def get_prices_all(pid_csv, date_from, date_to, page_size=1000, max_pages=1000, max_workers=8) -> pa.Table:
+    def fetch(page):
+        rows = get_prices_page(pid_csv, date_from, date_to, page=page, page_size=page_size)
+        return _change_rows_table(rows)
+
+    tables = [fetch(0)] if max_pages > 0 else []
+    if not tables or tables[0].num_rows < page_size:
+        return pa.concat_tables(tables) if tables else CHANGE_ROWS_SCHEMA.empty_table()
+
+    page = 1
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while page < max_pages:
+            wave = range(page, min(page + max_workers, max_pages))
+            # map() yields in page order, so rows stay ordered as in the sequential version
+            for tbl in pool.map(fetch, wave):
+                tables.append(tbl)
+                if tbl.num_rows < page_size:
+                    return pa.concat_tables(tables)
+            page = wave.stop
+    return pa.concat_tables(tables)
 
 # inclusive date range generator: d0..d1
 def _daterange(d0, d1):
@@ -197,76 +409,77 @@ def _daterange(d0, d1):
         current += timedelta(days=1)
 
 # Build a dense daily grid per productDefinitionId by forward-filling change points.
-def forward_fill_daily_grid(change_rows, season_start, season_end):
-    # group by productDefinitionId
-    by_pid = {}
-    for r in change_rows:
-        pid = r.get("productDefinitionId")
-        valid_at = r.get("validAt")
-        price = r.get("price")
-        if pid is None or valid_at is None or price is None:
-            continue
-        by_pid.setdefault(pid, []).append({"validAt": valid_at, "price": price})
-
-    dense = []
-    for pid, rows in by_pid.items():
-        # sort changes by date
-        rows.sort(key=lambda x: x["validAt"])
-        # walk the calendar and advance the pointer when we hit the next change
-        idx = -1
-        current_price = None
-
-        # fast-forward idx/current_price to the last change <= season_start
-        for i, r in enumerate(rows):
-            if r["validAt"] <= season_start.isoformat():
-                idx = i
-                current_price = r["price"]
-            else:
-                break
-
-        for day in _daterange(season_start, season_end):
-            # if the next change is today or earlier, advance
-            while (idx + 1) < len(rows) and rows[idx + 1]["validAt"] <= day.isoformat():
-                idx += 1
-                current_price = rows[idx]["price"]
-
-            # Only emit if we actually have a price as of this day
-            if current_price is not None:
-                dense.append({
-                    "productDefinitionId": pid,
-                    "valid_from": day.isoformat(),
-                    "price": current_price,
-                })
-    return dense
+# change_rows is the Arrow table from get_prices_all.
+# Returns a DataFrame with columns ('productDefinitionId', 'valid_from', 'price'); days before a product's first change are dropped.
+def forward_fill_daily_grid(change_rows: pa.Table, season_start, season_end) -> pd.DataFrame:
+    change_rows = change_rows.drop_null()
+    if change_rows.num_rows == 0:
+        return pd.DataFrame(columns=["productDefinitionId", "valid_from", "price"])
+
+    # plain int64 arrays: product id, change day as offset from season_start, price
+    n_days = (season_end - season_start).days + 1
+    pids = change_rows["productDefinitionId"].to_numpy()
+    days = change_rows["validAt"].cast(pa.date32()).cast(pa.int32()).to_numpy().astype("int64")
+    days -= (season_start - date(1970, 1, 1)).days
+    prices = change_rows["price"].to_numpy()
+
+    # sort changes by product, then date (stable: if a product lists the same date twice, the later entry wins).
+    # changes before/after the season are clamped to day -1 / n_days; only their order matters.
+    product_ids, pid_idx = np.unique(pids, return_inverse=True)
+    order = np.lexsort((days, pid_idx))
+    pid_idx, prices = pid_idx[order], prices[order]
+    days = np.clip(days[order], -1, n_days)
+
+    # keep the last entry per (product, day)
+    last = np.append((pid_idx[1:] != pid_idx[:-1]) | (days[1:] != days[:-1]), True)
+    pid_idx, days, prices = pid_idx[last], days[last], prices[last]
+
+    # each change holds its price from its day (at the earliest season start) until the product's next change;
+    # a product's last change runs until the sentinel day n_days (season end + 1). Runs are emitted whole with
+    # np.repeat, so nothing is searched or compared per day.
+    next_days = np.append(days[1:], n_days)
+    next_days[np.append(pid_idx[1:] != pid_idx[:-1], True)] = n_days
+    start = np.maximum(days, 0)
+    run = np.maximum(next_days - start, 0)  # 0 for changes replaced before the season or after its end
+
+    grid_pid = np.repeat(pid_idx, run)
+    grid_price = np.repeat(prices, run)
+    # day offsets inside each run: start, start + 1, ...
+    grid_day = np.repeat(start - (np.cumsum(run) - run), run) + np.arange(run.sum())
+
+    # format each calendar day once and look the strings up by day offset, instead of formatting every dense row
+    iso_days = np.array([d.isoformat() for d in _daterange(season_start, season_end)], dtype=object)
+    return pd.DataFrame({
+        "productDefinitionId": product_ids[grid_pid],
+        "valid_from": iso_days[grid_day],
+        "price": grid_price,
+    })
 
 # --------------- database upsert methods ----------------
-# products table upsert
-def upsert_pricenow_products(supabase_client, df: pd.DataFrame):
-    if df.empty:
+# products table upsert; records as returned by make_pricenow_products. conn: optional connection from db_transaction
+def upsert_pricenow_products(supabase_client, records: list[dict], conn=None):
+    if not records:
         return
 
     # sanity: product_id must be non-null
-    if df["product_id"].isnull().any():
-        missing = df[df["product_id"].isnull()]
+    missing = [r for r in records if r["product_id"] is None]
+    if missing:
         raise ValueError(f"Null product_id in products rows: {missing}")
 
-    upsert_df(
+    upsert_records(
         supabase_client,
         table="pricenow_products",
-        df=df[["product_id", "category", "age", "duration", "updated_at"]],
+        records=records,
         on_conflict="product_id",
-        chunk_size=1000,
+        chunk_size=10_000,
+        conn=conn,
     )
 
-# prices table upsert
-def upsert_pricenow_prices(supabase_client, df: pd.DataFrame):
+# prices table upsert. conn: optional connection from db_transaction
+def upsert_pricenow_prices(supabase_client, df: pd.DataFrame, conn=None):
     if df.empty:
         return
 
-    # ensure valid_from is ISO date
-    if "valid_from" in df.columns:
-        df["valid_from"] = pd.to_datetime(df["valid_from"]).dt.strftime("%Y-%m-%d")
-
     # sanity: product_id and valid_from must be non-null (primary key)
     for col in ("product_id", "valid_from"):
         if df[col].isnull().any():
@@ -278,15 +491,21 @@ def upsert_pricenow_prices(supabase_client, df: pd.DataFrame):
         table="pricenow_prices",
         df=df[["product_id", "valid_from", "price", "active", "updated_at"]],
         on_conflict="product_id,valid_from",
-        chunk_size=1000,
+        chunk_size=10_000,
+        conn=conn,
     )
 
 
 # ------------- main methods -------------
 # get metadata from product_API
-def make_pricenow_products_df(updated_at: datetime) -> pd.DataFrame:
-    # declare output df for the table pricenow_products
-    df = pd.DataFrame(columns=('product_id', 'category', 'age', 'duration', 'updated_at'))
+# Returns the rows for the table pricenow_products as a list of dicts (a few dozen rows; no DataFrame needed)
+# and duration_map {product_id: duration in days}, needed by make_pricenow_prices_df
+def make_pricenow_products(updated_at: datetime) -> tuple[list[dict], dict]:
+    # collect output rows for the table pricenow_products
+    records = []
+
+    # durations per product_id, for the active column of the prices table
+    duration_map = {}
 
     # declare list of product_ids; used to save prices later
     product_ids = []
@@ -312,68 +531,63 @@ def make_pricenow_products_df(updated_at: datetime) -> pd.DataFrame:
             duration_dict = attributes.get('duration') # duration attribute is a dictionary
             duration = duration_dict.get('value') # which contains the actual duration (4h, 1d, 2d, ..., 13d) in value
 
-            if duration == '4h':
-                duration_int = 1
-            else:
-                duration_int = int(str.replace(duration, 'd', '')) # remove d, coerce to integer
+            # durations without the '<n>d' pattern come from the lookup table; otherwise remove d, coerce to integer
+            duration_int = DURATION_DAYS[duration] if duration in DURATION_DAYS else int(duration.replace('d', ''))
 
             duration_map[product_id] = duration_int # save duration to dictionary with product_id as key, to later use with price_df
 
-            if age != 'small_child': # prevent small_child values from being saved; we don't sell those tickets
-                df.loc[len(df)] = [product_id, category, age, duration, updated_at] # save results to output df
+            if age not in EXCLUDED_AGES: # prevent e.g. small_child values from being saved; we don't sell those tickets
+                # note: updated_at is the run timestamp; if get_products answered from its cache,
+                # the catalog data itself can be up to PRODUCTS_CACHE_TTL older than that
+                records.append({ # save results to output rows
+                    "product_id": product_id,
+                    "category": category,
+                    "age": age,
+                    "duration": duration,
+                    "updated_at": updated_at,
+                })
                 product_ids.append(product_id)  # also save product_id to list of product_ids -> call later to get prices
 
-    return df
+    return records, duration_map
 
 # get live price data from pricing API
-def make_pricenow_prices_df(product_ids: list, updated_at: datetime) -> pd.DataFrame:
+def make_pricenow_prices_df(product_ids: list, duration_map: dict, updated_at: datetime) -> pd.DataFrame:
     # define season dates
     season_start = date(2025, 12, 13)
     season_end   = date(2026, 4, 12)
 
+    # join the product_ids once; the same string is sent with every page request
+    pid_csv = ",".join(map(str, product_ids))
+
     # fetch all change points across the season for all products (paginated)
-    change_rows = get_prices_all(product_ids, season_start.isoformat(), season_end.isoformat(), page_size=1000)
+    change_rows = get_prices_all(pid_csv, season_start.isoformat(), season_end.isoformat(), page_size=1000)
 
     # forward-fill into a dense daily grid
-    dense_rows = forward_fill_daily_grid(change_rows, season_start, season_end)
+    dense_df = forward_fill_daily_grid(change_rows, season_start, season_end)
 
-    # build dataframe
-    # columns: ('product_id', 'valid_from', 'price', 'active', 'updated_at')
-    records = []
-    for r in dense_rows:
-        pid = r["productDefinitionId"]
-        valid_from = r["valid_from"]            # 'YYYY-MM-DD'
-        price = r["price"]                      # integer minor units
-
-        # calculate active value
-        duration = duration_map.get(pid)  # get duration for ticket product_id
-        valid_from_date_obj = datetime.strptime(valid_from, "%Y-%m-%d").date() # make valid_from into a date object for calculating active column
-
-        # set days left in season manually for pre-season dates
-        if valid_from_date_obj == date(2025, 12, 13):
-            days_between = 2
-        elif valid_from_date_obj == date(2025, 12, 14):
-            days_between = 1
-        elif date(2025, 12, 14) < valid_from_date_obj < date(2025, 12, 19):
-            days_between = 0 # resort is closed in the week
-        # calculate it for all other dates
-        else:
-            days_between = (season_end - valid_from_date_obj).days + 1 # subtract start date from season end, + 1 for comparison to duration
-
-        if days_between >= duration:
-            active = True
-
-        else:
-            active = False
-
-        records.append((pid, valid_from, price, active, updated_at))
-
-    df = pd.DataFrame.from_records(
-        records,
-        columns=('product_id', 'valid_from', 'price', 'active', 'updated_at')
-    )
+    # calculate active value: a ticket is active if its duration still fits into the days left in the season
+    valid_from_ts = pd.to_datetime(dense_df["valid_from"], format="%Y-%m-%d")
+    days_between = (pd.Timestamp(season_end) - valid_from_ts).dt.days + 1 # + 1 for comparison to duration
+
+    # set days left in season manually for pre-season dates
+    preseason_days_between = {
+        pd.Timestamp(2025, 12, 13): 2,
+        pd.Timestamp(2025, 12, 14): 1,
+        **{pd.Timestamp(2025, 12, d): 0 for d in range(15, 19)}, # resort is closed in the week
+    }
+    days_between = valid_from_ts.map(preseason_days_between).fillna(days_between)
+
+    # get duration for ticket product_id: durations as a Series indexed by product_id, broadcast onto the price rows in one lookup
+    duration_s = pd.Series(duration_map, name="duration", dtype="int64")
+    duration = dense_df["productDefinitionId"].map(duration_s)
 
-    return df
+    # complete the dense grid in place into the pricenow_prices columns
+    # ('product_id', 'valid_from' as 'YYYY-MM-DD', 'price' in integer minor units, 'active', 'updated_at')
+    dense_df["active"] = days_between.to_numpy() >= duration.to_numpy()
+    dense_df["updated_at"] = updated_at
+    dense_df.rename(columns={"productDefinitionId": "product_id"}, inplace=True)
+
+    return dense_df
 
 
 # -----------------------------
@@ -401,6 +615,7 @@ AUTH_VERSION_HEADER = os.getenv("AUTH_VERSION_HEADER")
 PRICING_API_VERSION = os.getenv("PRICING_API_VERSION")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")  # optional: Postgres (session pooler) connection string, enables COPY upserts
 
 if not PRICENOW_CLIENT_SECRET or not PRICENOW_CLIENT_SECRET:
     raise RuntimeError("Missing Pricenow credentials")
@@ -411,18 +626,81 @@ if not AUDIENCE or not GRANT_TYPE or not AUTH_VERSION_HEADER or not PRICING_API_
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise RuntimeError("Missing Supabase credentials")
 
+# static request headers per API version; _authed_get only adds the Authorization header
+_HEADERS_MAIN = {
+    "Accept": "application/json",
+    "pratiq-api-version": MAIN_API_VERSION,
+}
+_HEADERS_PRICING = {
+    "Accept": "application/json",
+    "pratiq-api-version": PRICING_API_VERSION,
+}
+
+# payloads with at least this many rows use COPY instead of PostgREST (if SUPABASE_DB_URL is set)
+COPY_MIN_ROWS = 1000
+_db_unreachable = False  # set once connecting to SUPABASE_DB_URL failed
+# PostgREST request bodies are capped well below Supabase's ~8 MB limit; larger chunks are split
+REST_MAX_PAYLOAD_BYTES = 4 * 1024 * 1024
+
+# product attribute lookups
+EXCLUDED_AGES = {"small_child"}  # age categories we don't sell tickets for; not saved
+DURATION_DAYS = {"4h": 1}        # durations not in the '<n>d' format, as days (for the active column)
+
+# columns kept from the pricing API's change rows
+CHANGE_ROWS_SCHEMA = pa.schema([
+    ("productDefinitionId", pa.int64()),
+    ("validAt", pa.string()),  # 'YYYY-MM-DD'
+    ("price", pa.int64()),     # integer minor units
+])
+
 # -----------------------------
 # TOKEN CACHE (memory + disk)
 # -----------------------------
 CACHE_FILE = Path(".pricenow_token_cache.json")
 _token = None
 _token_expires_at = 0  # epoch seconds
+_token_lock = threading.Lock()
 
 # -----------------------------
-# MAIN CODE
+# RATE LIMIT (shared by all Pricenow API calls)
 # -----------------------------
-duration_map = {}
+RATE_LIMIT_MAX_RETRIES = 5   # retries on 429
+RATE_LIMIT_LOW_REMAINING = 8 # below this many remaining requests, space them out (= get_prices_all's max_workers)
+RATE_LIMIT_MAX_DELAY = 60.0  # cap for Retry-After / X-RateLimit-Reset pauses (seconds)
+_request_interval = 0.0      # seconds between request starts; 0 unless the quota is nearly used up
+_next_request_at = 0.0       # time.monotonic() before which no request may start
+_rate_limit_lock = threading.Lock()
 
+# -----------------------------
+# PRODUCTS CACHE (disk)
+# -----------------------------
+PRODUCTS_CACHE_FILE = Path(".pricenow_products_cache.json")
+# seconds; the scheduled runs (06:00 / 14:00 UTC, cache file kept between runs via actions/cache) are 8h / 16h apart:
+# the 14:00 run reuses the morning's catalog, the 06:00 run refetches (or revalidates via ETag) once a day
+PRODUCTS_CACHE_TTL = 12 * 3600
+
+# -----------------------------
+# HTTP SESSION (keep-alive + retries)
+# -----------------------------
+# one pooled session for all Pricenow calls: TLS handshake once per connection instead of once per request.
+# transient 5xx are retried with exponential backoff; 429 is left to the shared rate limiter (see _limited_get),
+# so urllib3 must not retry on Retry-After by itself either.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        respect_retry_after_header=False,
+        raise_on_status=False,  # hand the last response back so callers can report it
+    ),
+))
+
+# -----------------------------
+# MAIN CODE
+# -----------------------------
 if __name__ == "__main__":
     print(f"Environment: {ENV}")
     print(f"Auth URL:    {AUTH_URL}")
@@ -431,25 +709,26 @@ if __name__ == "__main__":
     # get timestamp info - both tables use it (saved in UTC, match local time at output)
     updated_at = datetime.now(timezone.utc).isoformat()
 
-    # make table for pricenow products
-    pricenow_products_df = make_pricenow_products_df(updated_at)
+    # make rows for pricenow products
+    pricenow_products, duration_map = make_pricenow_products(updated_at)
     print("Pulled products data")
 
-    # get product_ids from pricenow_products_df to pass to pricenow_prices method
-    product_ids = pricenow_products_df['product_id'].tolist()
+    # get product_ids from pricenow_products to pass to pricenow_prices method
+    product_ids = [r["product_id"] for r in pricenow_products]
 
     # make table for pricenow_prices
-    pricenow_prices_df = make_pricenow_prices_df(product_ids, updated_at)
+    pricenow_prices_df = make_pricenow_prices_df(product_ids, duration_map, updated_at)
     print("Pulled pricing data")
 
     # connect to supabase LeukerbaDB project
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    supabase = get_supabase()
 
-    upsert_pricenow_prices(supabase, pricenow_prices_df)
-    print("Updated prices table")
+    # upsert both tables (in one Postgres transaction if SUPABASE_DB_URL is set)
+    with db_transaction() as conn:
+        upsert_pricenow_prices(supabase, pricenow_prices_df, conn)
+        print("Updated prices table")
 
-    # upsert both tables
-    upsert_pricenow_products(supabase, pricenow_products_df)
-    print("Updated products table")
+        upsert_pricenow_products(supabase, pricenow_products, conn)
+        print("Updated products table")
 
 